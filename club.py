@@ -1,19 +1,48 @@
 import os
 import asyncio
-from datetime import datetime, timedelta
+import functools
+import logging
+import re
+import signal
+import time
+from dataclasses import dataclass
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from types import MappingProxyType
+from datetime import datetime
 from zoneinfo import ZoneInfo
 
 import aiosqlite
+from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger("club")
 
 MSK = ZoneInfo("Europe/Moscow")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
-ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
+ADMIN_CHAT_IDS = tuple(int(x) for x in os.getenv("ADMIN_CHAT_ID", "0").split(",") if x.strip())
+ADMIN_CHAT_ID = ADMIN_CHAT_IDS[0] if ADMIN_CHAT_IDS else 0
+ADMIN_IDS = frozenset(ADMIN_CHAT_IDS)
 DB_PATH = os.getenv("DB_PATH", "bot.db")
 
 PROXY_URL = (
@@ -24,19 +53,224 @@ PROXY_URL = (
     or os.getenv("http_proxy")
 )
 
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
+HTTP_LIMIT = 0
+HTTP_LIMIT_PER_HOST = 64
+HTTP_KEEPALIVE = 75
+HTTP_TIMEOUT = 10
+
+BLOCKED_USERS: set[int] = set()
+USER_PROFILE_CACHE_SIZE = 4096
+USER_PROFILE_CACHE: OrderedDict[int, tuple] = OrderedDict()
+USERS_PAGE_SIZE = 500
+
+ADMIN_MAP_CACHE_SIZE = 2048
+ADMIN_MAP_CACHE: OrderedDict[int, int] = OrderedDict()
+ADMIN_MAP_FLUSH_INTERVAL = 0.05
+ADMIN_MAP_PENDING: list[tuple[int, int]] = []
+
+EVENTS_LIST_LIMIT = 50
+STATS_PAGE_SIZE = 50
+EVENTS_CACHE_TTL = 30
+EVENTS_VERSION = 0
+EVENTS_CACHE: dict[str, tuple[int, float, object]] = {}
+
+ADMIN_LOG_BATCH = 100
+ADMIN_LOG_WAIT = float(os.getenv("ADMIN_LOG_WAIT", "2"))
+COPY_MESSAGES_MAX = 100
+ADMIN_REQUEST_ATTEMPTS = 5
+ADMIN_REQUEST_RETRY_DELAY = 5
+SHUTDOWN_DRAIN_TIMEOUT = 5
+
+SCHEDULER_BATCH = 100
+SCHEDULER_MAX_SLEEP = 300
+SCHEDULER_RETRY_DELAY = 20
+SCHEDULER_MAX_ATTEMPTS = 5
+JOB_ATTEMPTS: dict[int, int] = {}
+JOBS_WAKEUP = asyncio.Event()
+JOBS_NEXT_AT = float("inf")
+ADMIN_LOG_Q: asyncio.Queue[tuple[int, str, tuple, tuple[int, int] | None]] = asyncio.Queue()
+
+STALE_CALLBACK_CACHE_TIME = 3600
+
+OUTBOUND_RATE = 25
+OUTBOUND_WORKERS = 4
+OUTBOUND_PACE = {"next_at": 0.0}
+OUTBOUND_CHAT_HELD: dict[int, list] = {}
+BROADCAST_WINDOW = 50
+
+@dataclass(slots=True)
+class SendOp:
+    method: str
+    kwargs: dict
+    result: asyncio.Future
+
+OUTBOUND_Q: asyncio.Queue[SendOp] = asyncio.Queue()
+
 router = Router()
+BOT: Bot | None = None
+
+def orjson_dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
+
+class PooledAiohttpSession(AiohttpSession):
+    def __init__(self, proxy=None, **kwargs):
+        if orjson:
+            kwargs.setdefault("json_loads", orjson.loads)
+            kwargs.setdefault("json_dumps", orjson_dumps)
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        super().__init__(proxy=proxy, limit=HTTP_LIMIT, **kwargs)
+        self._connector_init.update(
+            limit=HTTP_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE,
+        )
 
-def is_admin(chat_id: int) -> bool:
-    return chat_id == ADMIN_CHAT_ID
+BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+async def gather_logged(what: str, *aws):
+    for r in await asyncio.gather(*aws, return_exceptions=True):
+        if isinstance(r, Exception):
+            log.warning("%s: %r", what, r)
+
+def outbound(method: str, **kwargs) -> asyncio.Future:
+    fut = asyncio.get_running_loop().create_future()
+    OUTBOUND_Q.put_nowait(SendOp(method, kwargs, fut))
+    return fut
+
+async def outbound_wait_slot():
+    now = asyncio.get_running_loop().time()
+    slot = max(now, OUTBOUND_PACE["next_at"])
+    OUTBOUND_PACE["next_at"] = slot + 1 / OUTBOUND_RATE
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+def outbound_release(chat_id: int):
+    for op in OUTBOUND_CHAT_HELD.pop(chat_id, ()):
+        OUTBOUND_Q.put_nowait(op)
+        OUTBOUND_Q.task_done()
+
+async def outbound_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        op = await OUTBOUND_Q.get()
+        deferred = False
+        try:
+            if op.result.cancelled():
+                continue
+            chat_id = op.kwargs.get("chat_id")
+            held = OUTBOUND_CHAT_HELD.get(chat_id)
+            if held is not None:
+                held.append(op)
+                deferred = True
+                continue
+            await outbound_wait_slot()
+            try:
+                res = await getattr(BOT, op.method)(**op.kwargs)
+            except TelegramRetryAfter as e:
+                held = OUTBOUND_CHAT_HELD.get(chat_id)
+                if held is None:
+                    OUTBOUND_CHAT_HELD[chat_id] = [op]
+                    loop.call_later(e.retry_after, outbound_release, chat_id)
+                else:
+                    held.insert(0, op)
+                deferred = True
+            except Exception as e:
+                if not op.result.done():
+                    op.result.set_exception(e)
+            else:
+                if not op.result.done():
+                    op.result.set_result(res)
+        finally:
+            if not deferred:
+                OUTBOUND_Q.task_done()
+
+async def broadcast_text(user_ids, text: str) -> tuple[int, int]:
+    if not hasattr(user_ids, "__aiter__"):
+        user_ids = aiter_of(user_ids)
+    window = asyncio.Semaphore(BROADCAST_WINDOW)
+    total = sent = failed = 0
+    sample = None
+
+    def on_done(fut: asyncio.Future):
+        nonlocal sent, failed, sample
+        window.release()
+        exc = fut.exception() if not fut.cancelled() else asyncio.CancelledError()
+        if exc is None:
+            sent += 1
+        elif not isinstance(exc, TelegramForbiddenError):
+            failed += 1
+            sample = sample or exc
+
+    async for uid in user_ids:
+        total += 1
+        if db_is_blocked(uid):
+            continue
+        await window.acquire()
+        outbound("send_message", chat_id=uid, text=text).add_done_callback(on_done)
+    for _ in range(BROADCAST_WINDOW):
+        await window.acquire()
+    if failed:
+        log.warning("broadcast: %d of %d sends failed, e.g. %r", failed, total, sample)
+    return sent, total
+
+async def aiter_of(items):
+    for item in items:
+        yield item
+
+is_admin = ADMIN_IDS.__contains__
+
+@functools.lru_cache(maxsize=4096)
+def _user_label(user_id: int, username: str | None, first_name: str | None, last_name: str | None) -> str:
+    if username:
+        return "@" + username
+    if first_name and last_name:
+        return first_name + " " + last_name
+    return first_name or last_name or str(user_id)
 
 def user_label(u) -> str:
-    if u.username:
-        return f"@{u.username}"
-    name = " ".join([x for x in [u.first_name, u.last_name] if x])
-    return name if name else str(u.id)
+    return _user_label(u.id, u.username, u.first_name, u.last_name)
+
+def events_changed():
+    global EVENTS_VERSION
+    EVENTS_VERSION += 1
+
+def events_cache_get(key: str):
+    hit = EVENTS_CACHE.get(key)
+    if hit and hit[0] == EVENTS_VERSION and time.monotonic() - hit[1] < EVENTS_CACHE_TTL:
+        return hit[2]
+    return None
+
+def events_cache_put(key: str, version: int, value):
+    EVENTS_CACHE[key] = (version, time.monotonic(), value)
+    return value
+
+def unix_now() -> int:
+    return int(time.time())
+
+ARG_RE = re.compile(r"\s*(\S*)\s*")
+
+def next_arg(text: str) -> tuple[str, str]:
+    m = ARG_RE.match(text)
+    return m[1], text[m.end():]
+
+@functools.lru_cache(maxsize=4096)
+def _fmt_minute(minute: int) -> str:
+    return datetime.fromtimestamp(minute * 60, tz=MSK).strftime("%d.%m.%Y %H:%M")
 
 def fmt_dt(ts: int) -> str:
-    return datetime.fromtimestamp(ts, tz=MSK).strftime("%d.%m.%Y %H:%M")
+    return _fmt_minute(ts // 60)
 
 def main_menu_kb():
     kb = InlineKeyboardBuilder()
@@ -60,6 +294,28 @@ def cancel_entry_btn_kb():
     kb.adjust(1)
     return kb.as_markup()
 
+MAIN_MENU_KB = main_menu_kb()
+BACK_MAIN_KB = back_main_kb()
+CANCEL_ENTRY_KB = cancel_entry_btn_kb()
+BACK_ROW = (InlineKeyboardButton(text="Назад", callback_data="menu:back"),)
+SCHEDULE_TAIL_ROWS = (
+    [InlineKeyboardButton(text="Отменить запись", callback_data="user:cancel_menu")],
+    list(BACK_ROW),
+)
+
+HELP_TO = "Формат: /to <user_id> <текст>"
+HELP_ADD_EVENT = "Формат: /add_event YYYY-MM-DD HH:MM <места> <название>"
+HELP_DEL_EVENT = "Формат: /del_event <event_id>"
+HELP_SET_LINK = "Формат: /set_link <event_id> <ссылка>"
+HELP_BROADCAST_ALL = "Формат: /broadcast_all <текст>"
+HELP_BROADCAST = "Формат: /broadcast <user_ids через запятую или @username> <текст>"
+HELP_BROADCAST_EVENT = "Формат: /broadcast_event <event_id> <текст>"
+HELP_THANKS_EVENT = "Формат: /thanks_event <event_id> <ссылка_на_пост>"
+HELP_CANCEL_SIGNUP = "Формат: /cancel_signup <event_id> <user_id или @username>"
+HELP_BLOCK = "Формат: /block <user_id или @username>"
+HELP_UNBLOCK = "Формат: /unblock <user_id или @username>"
+
+@functools.lru_cache(maxsize=256)
 def confirm_kb(event_id: int):
     kb = InlineKeyboardBuilder()
     kb.button(text="Да", callback_data=f"confirm:{event_id}:yes")
@@ -75,13 +331,15 @@ def admin_request_kb(event_id: int, user_id: int):
     return kb.as_markup()
 
 def admin_events_kb(prefix: str, events_rows):
-    kb = InlineKeyboardBuilder()
-    for event_id, start_ts, title, capacity, remaining, link in events_rows:
-        left_text = "МЕСТ НЕТ" if remaining <= 0 else f"{remaining}/{capacity}"
-        kb.button(text=f"#{event_id} {fmt_dt(start_ts)} — {title} ({left_text})", callback_data=f"{prefix}:{event_id}")
-    kb.adjust(1)
-    return kb.as_markup()
-
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=f"#{event_id} {fmt_dt(start_ts)} — {title} ({'МЕСТ НЕТ' if remaining <= 0 else f'{remaining}/{capacity}'})",
+            callback_data=f"{prefix}:{event_id}"
+        )]
+        for event_id, start_ts, title, capacity, remaining, link in events_rows
+    ])
+
+@functools.lru_cache(maxsize=256)
 def payment_kb(event_id: int, include_reason: bool = True):
     kb = InlineKeyboardBuilder()
     kb.button(text="💳 ОПЛАТИТЬ", url="https://pay.cloudtips.ru/p/18eb8c24")
@@ -92,6 +350,7 @@ def payment_kb(event_id: int, include_reason: bool = True):
     kb.adjust(1)
     return kb.as_markup()
 
+@functools.lru_cache(maxsize=256)
 def payment_text_html(start_ts: int, title: str):
     return (
         "Вы выбрали встречу:\n"
@@ -101,9 +360,84 @@ def payment_text_html(start_ts: int, title: str):
         "После оплаты нажмите кнопку “Я уже оплатила”"
     )
 
+DB_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL;"
+    "PRAGMA busy_timeout=5000;"
+    "PRAGMA cache_size=-20000;"
+    "PRAGMA temp_store=MEMORY;"
+    "PRAGMA mmap_size=268435456;"
+    "PRAGMA foreign_keys=ON;"
+)
+DB_OPTIMIZE_INTERVAL = 900
+DB_CHECKPOINT_INTERVAL = 3600
+DB_STATEMENT_CACHE = 256
+
+_DB: aiosqlite.Connection | None = None
+_DB_OPEN_LOCK = asyncio.Lock()
+_DB_WRITE_LOCK = asyncio.Lock()
+_DB_IN_TX: ContextVar[bool] = ContextVar("_DB_IN_TX", default=False)
+
+async def db_connect() -> aiosqlite.Connection:
+    db = await aiosqlite.connect(DB_PATH, cached_statements=DB_STATEMENT_CACHE)
+    try:
+        await db.executescript(DB_PRAGMAS)
+    except BaseException:
+        await db.close()
+        raise
+    return db
+
+async def get_db() -> aiosqlite.Connection:
+    global _DB
+    if _DB is None:
+        async with _DB_OPEN_LOCK:
+            if _DB is None:
+                _DB = await db_connect()
+    return _DB
+
+@asynccontextmanager
+async def db_tx():
+    db = await get_db()
+    if _DB_IN_TX.get():
+        yield db
+        return
+    async with _DB_WRITE_LOCK:
+        token = _DB_IN_TX.set(True)
+        try:
+            await db.execute("BEGIN IMMEDIATE;")
+            try:
+                yield db
+            except BaseException:
+                await db.rollback()
+                raise
+            await db.commit()
+        finally:
+            _DB_IN_TX.reset(token)
+
+async def db_close():
+    global _DB
+    if _DB is not None:
+        await _DB.close()
+        _DB = None
+
+async def db_maintenance_loop():
+    last_checkpoint = time.monotonic()
+    while True:
+        await asyncio.sleep(DB_OPTIMIZE_INTERVAL)
+        try:
+            await db_cleanup_old_events()
+            db = await get_db()
+            if time.monotonic() - last_checkpoint >= DB_CHECKPOINT_INTERVAL:
+                async with _DB_WRITE_LOCK:
+                    await db.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                last_checkpoint = time.monotonic()
+            await db.execute("PRAGMA optimize;")
+        except Exception:
+            log.exception("database maintenance failed")
+
 async def db_init():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA journal_mode=WAL;")
+    db = await get_db()
+    await db.execute("PRAGMA journal_mode=WAL;")
+    async with db_tx() as db:
         await db.execute("""
             CREATE TABLE IF NOT EXISTS users(
                 user_id INTEGER PRIMARY KEY,
@@ -174,435 +508,612 @@ async def db_init():
                 PRIMARY KEY(user_id, event_id)
             );
         """)
-        await db.commit()
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs(sent, run_ts);")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_signups_event_status ON signups(event_id, status);")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_events_start_ts ON events(start_ts);")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_requests_event ON requests(event_id);")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);")
+    async with db.execute("SELECT user_id FROM blocked_users") as cur:
+        BLOCKED_USERS.update([row[0] async for row in cur])
 
-async def db_is_blocked(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT 1 FROM blocked_users WHERE user_id=? LIMIT 1", (user_id,))
-        return (await cur.fetchone()) is not None
+def db_is_blocked(user_id: int) -> bool:
+    return user_id in BLOCKED_USERS
 
 async def db_block_user(user_id: int):
-    now_ts = int(datetime.now(tz=MSK).timestamp())
-    async with aiosqlite.connect(DB_PATH) as db:
+    now_ts = unix_now()
+    async with db_tx() as db:
         await db.execute("INSERT OR REPLACE INTO blocked_users(user_id, blocked_ts) VALUES(?,?)", (user_id, now_ts))
-        await db.commit()
+    BLOCKED_USERS.add(user_id)
 
 async def db_unblock_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_tx() as db:
         await db.execute("DELETE FROM blocked_users WHERE user_id=?", (user_id,))
-        await db.commit()
+    BLOCKED_USERS.discard(user_id)
 
 async def db_user_upsert(u):
-    now_ts = int(datetime.now(tz=MSK).timestamp())
-    async with aiosqlite.connect(DB_PATH) as db:
+    profile = (u.username, u.first_name, u.last_name)
+    if USER_PROFILE_CACHE.get(u.id) == profile:
+        USER_PROFILE_CACHE.move_to_end(u.id)
+        return
+    now_ts = unix_now()
+    async with db_tx() as db:
         await db.execute(
             "INSERT INTO users(user_id, username, first_name, last_name, started_ts) VALUES(?,?,?,?,?) "
             "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name",
             (u.id, u.username, u.first_name, u.last_name, now_ts)
         )
-        await db.commit()
+    USER_PROFILE_CACHE[u.id] = profile
+    USER_PROFILE_CACHE.move_to_end(u.id)
+    if len(USER_PROFILE_CACHE) > USER_PROFILE_CACHE_SIZE:
+        USER_PROFILE_CACHE.popitem(last=False)
+
+def admin_map_cache_put(admin_msg_id: int, user_id: int):
+    ADMIN_MAP_CACHE[admin_msg_id] = user_id
+    ADMIN_MAP_CACHE.move_to_end(admin_msg_id)
+    if len(ADMIN_MAP_CACHE) > ADMIN_MAP_CACHE_SIZE:
+        ADMIN_MAP_CACHE.popitem(last=False)
+
+def db_add_admin_map(admin_msg_id: int, user_id: int):
+    ADMIN_MAP_PENDING.append((admin_msg_id, user_id))
+    admin_map_cache_put(admin_msg_id, user_id)
+
+async def db_flush_admin_map():
+    if not ADMIN_MAP_PENDING:
+        return
+    rows = ADMIN_MAP_PENDING[:]
+    ADMIN_MAP_PENDING.clear()
+    try:
+        async with db_tx() as db:
+            await db.executemany("INSERT OR REPLACE INTO admin_map(admin_msg_id, user_id) VALUES(?,?)", rows)
+    except BaseException:
+        ADMIN_MAP_PENDING[:0] = rows
+        raise
 
-async def db_add_admin_map(admin_msg_id: int, user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR REPLACE INTO admin_map(admin_msg_id, user_id) VALUES(?,?)", (admin_msg_id, user_id))
-        await db.commit()
+async def admin_map_flusher():
+    while True:
+        await asyncio.sleep(ADMIN_MAP_FLUSH_INTERVAL)
+        try:
+            await db_flush_admin_map()
+        except Exception:
+            log.exception("admin_map flush failed")
 
 async def db_get_mapped_user(admin_msg_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT user_id FROM admin_map WHERE admin_msg_id=?", (admin_msg_id,))
-        row = await cur.fetchone()
-        return row[0] if row else None
-
-async def db_all_users():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT user_id FROM users")
-        return [r[0] for r in await cur.fetchall()]
-
-async def db_list_events_future():
-    now_ts = int(datetime.now(tz=MSK).timestamp())
-    async with aiosqlite.connect(DB_PATH) as db:
+    user_id = ADMIN_MAP_CACHE.get(admin_msg_id)
+    if user_id is not None:
+        ADMIN_MAP_CACHE.move_to_end(admin_msg_id)
+        return user_id
+    db = await get_db()
+    cur = await db.execute("SELECT user_id FROM admin_map WHERE admin_msg_id=?", (admin_msg_id,))
+    row = await cur.fetchone()
+    if not row:
+        return None
+    admin_map_cache_put(admin_msg_id, row[0])
+    return row[0]
+
+async def db_all_active_users():
+    db = await get_db()
+    last_id = 0
+    while True:
         cur = await db.execute(
-            "SELECT event_id, start_ts, title, capacity, remaining, COALESCE(link,'') FROM events WHERE start_ts>? ORDER BY start_ts ASC",
-            (now_ts,)
+            "SELECT u.user_id FROM users u LEFT JOIN blocked_users b ON b.user_id=u.user_id "
+            "WHERE b.user_id IS NULL AND u.user_id>? ORDER BY u.user_id LIMIT ?",
+            (last_id, USERS_PAGE_SIZE)
         )
-        return await cur.fetchall()
+        rows = await cur.fetchall()
+        for row in rows:
+            yield row[0]
+        if len(rows) < USERS_PAGE_SIZE:
+            return
+        last_id = rows[-1][0]
+
+async def db_user_id_by_username(username: str):
+    db = await get_db()
+    cur = await db.execute("SELECT user_id FROM users WHERE username=? LIMIT 1", (username,))
+    row = await cur.fetchone()
+    return int(row[0]) if row else None
+
+async def resolve_user(token: str):
+    if token.startswith("@"):
+        return await db_user_id_by_username(token[1:])
+    if token.isdigit():
+        return int(token)
+    return None
+
+async def db_user_ids_by_username(usernames):
+    if not usernames:
+        return {}
+    if len(usernames) == 1:
+        uid = await db_user_id_by_username(usernames[0])
+        return {usernames[0]: uid} if uid is not None else {}
+    db = await get_db()
+    cur = await db.execute(
+        f"SELECT username, user_id FROM users WHERE username IN ({','.join('?' * len(usernames))})",
+        usernames
+    )
+    return dict(await cur.fetchall())
+
+async def db_list_events_future():
+    now_ts = unix_now()
+    db = await get_db()
+    cur = await db.execute(
+        "SELECT event_id, start_ts, title, capacity, remaining, COALESCE(link,'') FROM events WHERE start_ts>? ORDER BY start_ts ASC LIMIT ?",
+        (now_ts, EVENTS_LIST_LIMIT)
+    )
+    return await cur.fetchall()
 
 async def db_list_events_recent_for_admin():
-    now_ts = int(datetime.now(tz=MSK).timestamp())
+    now_ts = unix_now()
     old_ts = now_ts - 86400 * 30
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT event_id, start_ts, title, capacity, remaining, COALESCE(link,'') FROM events WHERE start_ts>? ORDER BY start_ts ASC",
-            (old_ts,)
-        )
-        return await cur.fetchall()
+    db = await get_db()
+    cur = await db.execute(
+        "SELECT event_id, start_ts, title, capacity, remaining, COALESCE(link,'') FROM events WHERE start_ts>? ORDER BY start_ts ASC",
+        (old_ts,)
+    )
+    return await cur.fetchall()
 
 async def db_get_event(event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT event_id, start_ts, title, capacity, remaining, COALESCE(link,'') FROM events WHERE event_id=?",
-            (event_id,)
-        )
-        return await cur.fetchone()
+    db = await get_db()
+    cur = await db.execute(
+        "SELECT event_id, start_ts, title, capacity, remaining, COALESCE(link,'') FROM events WHERE event_id=?",
+        (event_id,)
+    )
+    return await cur.fetchone()
 
 async def db_add_event(start_ts: int, title: str, capacity: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_tx() as db:
         cur = await db.execute(
             "INSERT INTO events(start_ts, title, capacity, remaining, link) VALUES(?,?,?,?,NULL)",
             (start_ts, title, capacity, capacity)
         )
-        await db.commit()
-        return cur.lastrowid
+    events_changed()
+    return cur.lastrowid
 
 async def db_delete_event(event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_tx() as db:
         await db.execute("DELETE FROM events WHERE event_id=?", (event_id,))
         await db.execute("DELETE FROM requests WHERE event_id=?", (event_id,))
         await db.execute("DELETE FROM signups WHERE event_id=?", (event_id,))
         await db.execute("DELETE FROM jobs WHERE event_id=?", (event_id,))
         await db.execute("DELETE FROM pending_payments WHERE event_id=?", (event_id,))
-        await db.commit()
+    events_changed()
 
 async def db_set_link(event_id: int, link: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_tx() as db:
         await db.execute("UPDATE events SET link=? WHERE event_id=?", (link, event_id))
-        await db.commit()
+    events_changed()
 
 async def db_add_request_log(user_id: int, event_id: int, status: str):
-    now_ts = int(datetime.now(tz=MSK).timestamp())
-    async with aiosqlite.connect(DB_PATH) as db:
+    now_ts = unix_now()
+    async with db_tx() as db:
         await db.execute(
             "INSERT INTO requests(user_id, event_id, status, created_ts) VALUES(?,?,?,?)",
             (user_id, event_id, status, now_ts)
         )
-        await db.commit()
 
 async def db_signup_get(user_id: int, event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT status, confirm_status FROM signups WHERE user_id=? AND event_id=?",
-            (user_id, event_id)
-        )
-        return await cur.fetchone()
+    db = await get_db()
+    cur = await db.execute(
+        "SELECT status, confirm_status FROM signups WHERE user_id=? AND event_id=?",
+        (user_id, event_id)
+    )
+    return await cur.fetchone()
 
 async def db_signup_confirm(user_id: int, event_id: int):
-    now_ts = int(datetime.now(tz=MSK).timestamp())
-    async with aiosqlite.connect(DB_PATH) as db:
+    now_ts = unix_now()
+    async with db_tx() as db:
         await db.execute(
             "INSERT INTO signups(user_id, event_id, status, confirm_status, confirmed_ts) VALUES(?,?,?,?,?) "
             "ON CONFLICT(user_id, event_id) DO UPDATE SET status='confirmed', confirm_status='unknown', confirmed_ts=?",
             (user_id, event_id, "confirmed", "unknown", now_ts, now_ts)
         )
-        await db.commit()
+
+async def db_signup_event(user_id: int, event_id: int):
+    db = await get_db()
+    cur = await db.execute(
+        "SELECT s.status, e.start_ts, e.title FROM signups s JOIN events e ON e.event_id=s.event_id "
+        "WHERE s.user_id=? AND s.event_id=?",
+        (user_id, event_id)
+    )
+    return await cur.fetchone()
 
 async def db_set_confirm_status(user_id: int, event_id: int, status: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_tx() as db:
         await db.execute(
             "UPDATE signups SET confirm_status=? WHERE user_id=? AND event_id=?",
             (status, user_id, event_id)
         )
-        await db.commit()
-
-async def db_set_signup_cancelled(user_id: int, event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE signups SET status='cancelled', confirm_status='no' WHERE user_id=? AND event_id=?",
-            (user_id, event_id)
-        )
-        await db.commit()
-
-async def db_event_decrement_remaining(event_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("BEGIN IMMEDIATE;")
-        cur = await db.execute("SELECT remaining FROM events WHERE event_id=?", (event_id,))
-        row = await cur.fetchone()
-        if not row:
-            await db.execute("ROLLBACK;")
-            return False
-        rem = int(row[0])
-        if rem <= 0:
-            await db.execute("ROLLBACK;")
-            return False
-        await db.execute("UPDATE events SET remaining=? WHERE event_id=?", (rem - 1, event_id))
-        await db.commit()
-        return True
 
 async def db_event_increment_remaining(event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("BEGIN IMMEDIATE;")
-        cur = await db.execute("SELECT remaining, capacity FROM events WHERE event_id=?", (event_id,))
-        row = await cur.fetchone()
-        if not row:
-            await db.execute("ROLLBACK;")
-            return
-        rem, cap = int(row[0]), int(row[1])
-        rem2 = rem + 1
-        if rem2 > cap:
-            rem2 = cap
-        await db.execute("UPDATE events SET remaining=? WHERE event_id=?", (rem2, event_id))
-        await db.commit()
+    async with db_tx() as db:
+        await db.execute("UPDATE events SET remaining=MIN(remaining+1, capacity) WHERE event_id=?", (event_id,))
+    events_changed()
+
+def jobs_added(run_ts: int):
+    if run_ts < JOBS_NEXT_AT:
+        JOBS_WAKEUP.set()
 
 async def db_add_job(job_type: str, user_id: int, event_id: int, run_ts: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_tx() as db:
         await db.execute(
             "INSERT INTO jobs(job_type, user_id, event_id, run_ts, sent) VALUES(?,?,?,?,0)",
             (job_type, user_id, event_id, run_ts)
         )
-        await db.commit()
+    jobs_added(run_ts)
 
-async def db_next_jobs(now_ts: int, limit: int = 50):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT job_id, job_type, user_id, event_id, run_ts FROM jobs WHERE sent=0 AND run_ts<=? ORDER BY run_ts ASC LIMIT ?",
-            (now_ts, limit)
+async def db_add_jobs(rows):
+    async with db_tx() as db:
+        await db.executemany(
+            "INSERT INTO jobs(job_type, user_id, event_id, run_ts, sent) VALUES(?,?,?,?,0)",
+            rows
         )
-        return await cur.fetchall()
+    jobs_added(min(row[3] for row in rows))
 
-async def db_mark_job_sent(job_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE jobs SET sent=1 WHERE job_id=?", (job_id,))
-        await db.commit()
-
-async def db_event_stats(event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def db_approve_atomic(user_id: int, event_id: int):
+    now_ts = unix_now()
+    async with db_tx() as db:
         cur = await db.execute(
-            "SELECT u.user_id, COALESCE(u.username,''), COALESCE(u.first_name,''), COALESCE(u.last_name,'') "
-            "FROM signups s JOIN users u ON u.user_id=s.user_id "
-            "WHERE s.event_id=? AND s.status='confirmed' ORDER BY u.username ASC",
+            "UPDATE events SET remaining=remaining-1 WHERE event_id=? AND remaining>0 RETURNING start_ts, title",
             (event_id,)
         )
-        return await cur.fetchall()
+        rows = await cur.fetchall()
+        if not rows:
+            return None
+        start_ts, title = rows[0]
+        confirm_ts = start_ts - 86400
+        reminder_ts = start_ts - 3600
+        await db_add_request_log(user_id, event_id, "approved")
+        await db_signup_confirm(user_id, event_id)
+        await db_payment_mark_approved(user_id, event_id)
+        await db_add_jobs([
+            ("confirm", user_id, event_id, now_ts if confirm_ts <= now_ts else confirm_ts),
+            ("reminder", user_id, event_id, now_ts if reminder_ts <= now_ts else reminder_ts),
+            ("start_notice", user_id, event_id, start_ts if start_ts > now_ts else now_ts),
+        ])
+    events_changed()
+    return start_ts, title
+
+async def db_decline_atomic(user_id: int, event_id: int):
+    async with db_tx() as db:
+        await db_add_request_log(user_id, event_id, "declined")
+        await db_payment_mark_declined(user_id, event_id)
+        cur = await db.execute("SELECT start_ts, title FROM events WHERE event_id=?", (event_id,))
+        return await cur.fetchone()
 
-async def db_event_confirmed_user_ids(event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def db_cancel_signup_atomic(user_id: int, event_id: int):
+    async with db_tx() as db:
         cur = await db.execute(
-            "SELECT user_id FROM signups WHERE event_id=? AND status='confirmed'",
-            (event_id,)
+            "UPDATE signups SET status='cancelled', confirm_status='no' WHERE user_id=? AND event_id=? AND status='confirmed'",
+            (user_id, event_id)
         )
-        return [r[0] for r in await cur.fetchall()]
+        if cur.rowcount != 1:
+            return None
+        await db_event_increment_remaining(event_id)
+        await db_payment_mark_cancelled(user_id, event_id)
+        cur = await db.execute("SELECT start_ts, title FROM events WHERE event_id=?", (event_id,))
+        return await cur.fetchone()
+
+async def db_next_jobs(now_ts: int, limit: int = 50):
+    db = await get_db()
+    cur = await db.execute(
+        "SELECT j.job_id, j.job_type, j.user_id, j.event_id, e.start_ts, e.title, COALESCE(e.link,''), s.status, p.status "
+        "FROM jobs j "
+        "LEFT JOIN events e ON e.event_id=j.event_id "
+        "LEFT JOIN signups s ON s.user_id=j.user_id AND s.event_id=j.event_id "
+        "LEFT JOIN pending_payments p ON p.user_id=j.user_id AND p.event_id=j.event_id "
+        "WHERE j.sent=0 AND j.run_ts<=? ORDER BY j.run_ts ASC LIMIT ?",
+        (now_ts, limit)
+    )
+    return await cur.fetchall()
+
+async def db_next_job_ts():
+    db = await get_db()
+    cur = await db.execute("SELECT MIN(run_ts) FROM jobs WHERE sent=0")
+    row = await cur.fetchone()
+    return row[0]
+
+async def db_mark_jobs_sent(job_ids):
+    if not job_ids:
+        return
+    async with db_tx() as db:
+        await db.execute(
+            f"UPDATE jobs SET sent=1 WHERE job_id IN ({','.join('?' * len(job_ids))})",
+            job_ids
+        )
+
+async def db_event_confirmed_count(event_id: int) -> int:
+    db = await get_db()
+    cur = await db.execute(
+        "SELECT COUNT(*) FROM signups s JOIN users u ON u.user_id=s.user_id "
+        "WHERE s.event_id=? AND s.status='confirmed'",
+        (event_id,)
+    )
+    return (await cur.fetchone())[0]
+
+async def db_event_stats(event_id: int, offset: int = 0, limit: int = -1):
+    db = await get_db()
+    async with db.execute(
+        "SELECT u.user_id, COALESCE(u.username,''), COALESCE(u.first_name,''), COALESCE(u.last_name,'') "
+        "FROM signups s JOIN users u ON u.user_id=s.user_id "
+        "WHERE s.event_id=? AND s.status='confirmed' ORDER BY u.username ASC, u.user_id ASC "
+        "LIMIT ? OFFSET ?",
+        (event_id, limit, offset)
+    ) as cur:
+        async for row in cur:
+            yield row
+
+async def db_event_confirmed_user_ids(event_id: int):
+    db = await get_db()
+    cur = await db.execute(
+        "SELECT user_id FROM signups WHERE event_id=? AND status='confirmed' "
+        "AND user_id NOT IN (SELECT user_id FROM blocked_users)",
+        (event_id,)
+    )
+    return [r[0] for r in await cur.fetchall()]
 
 async def db_cleanup_old_events():
-    now_ts = int(datetime.now(tz=MSK).timestamp())
+    now_ts = unix_now()
     old_ts = now_ts - 86400 * 30
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT event_id FROM events WHERE start_ts<?", (old_ts,))
-        rows = await cur.fetchall()
-        for (eid,) in rows:
-            await db.execute("DELETE FROM events WHERE event_id=?", (eid,))
-            await db.execute("DELETE FROM requests WHERE event_id=?", (eid,))
-            await db.execute("DELETE FROM signups WHERE event_id=?", (eid,))
-            await db.execute("DELETE FROM jobs WHERE event_id=?", (eid,))
-            await db.execute("DELETE FROM pending_payments WHERE event_id=?", (eid,))
-        await db.commit()
+    async with db_tx() as db:
+        for table in ("requests", "signups", "jobs", "pending_payments"):
+            await db.execute(
+                f"DELETE FROM {table} WHERE event_id IN (SELECT event_id FROM events WHERE start_ts<?)",
+                (old_ts,)
+            )
+        await db.execute("DELETE FROM events WHERE start_ts<?", (old_ts,))
 
 async def db_user_confirmed_future_events(user_id: int):
-    now_ts = int(datetime.now(tz=MSK).timestamp())
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT e.event_id, e.start_ts, e.title, e.capacity, e.remaining, COALESCE(e.link,'') "
-            "FROM signups s JOIN events e ON e.event_id=s.event_id "
-            "WHERE s.user_id=? AND s.status='confirmed' AND e.start_ts>? "
-            "ORDER BY e.start_ts ASC",
-            (user_id, now_ts)
-        )
-        return await cur.fetchall()
+    now_ts = unix_now()
+    db = await get_db()
+    cur = await db.execute(
+        "SELECT e.event_id, e.start_ts, e.title, e.capacity, e.remaining, COALESCE(e.link,'') "
+        "FROM signups s JOIN events e ON e.event_id=s.event_id "
+        "WHERE s.user_id=? AND s.status='confirmed' AND e.start_ts>? "
+        "ORDER BY e.start_ts ASC LIMIT ?",
+        (user_id, now_ts, EVENTS_LIST_LIMIT)
+    )
+    return await cur.fetchall()
 
 async def db_payment_get(user_id: int, event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT status, selected_ts, paid_clicked_ts FROM pending_payments WHERE user_id=? AND event_id=?",
-            (user_id, event_id)
-        )
-        return await cur.fetchone()
+    db = await get_db()
+    cur = await db.execute(
+        "SELECT status, selected_ts, paid_clicked_ts FROM pending_payments WHERE user_id=? AND event_id=?",
+        (user_id, event_id)
+    )
+    return await cur.fetchone()
 
 async def db_payment_set_selected(user_id: int, event_id: int):
-    now_ts = int(datetime.now(tz=MSK).timestamp())
-    async with aiosqlite.connect(DB_PATH) as db:
+    now_ts = unix_now()
+    async with db_tx() as db:
         await db.execute(
             "INSERT INTO pending_payments(user_id, event_id, status, selected_ts, paid_clicked_ts) VALUES(?,?,?,?,NULL) "
             "ON CONFLICT(user_id, event_id) DO UPDATE SET status='selected', selected_ts=excluded.selected_ts, paid_clicked_ts=NULL",
             (user_id, event_id, "selected", now_ts)
         )
-        await db.commit()
     return now_ts
 
 async def db_payment_mark_paid(user_id: int, event_id: int):
-    now_ts = int(datetime.now(tz=MSK).timestamp())
-    async with aiosqlite.connect(DB_PATH) as db:
+    now_ts = unix_now()
+    async with db_tx() as db:
         await db.execute(
             "INSERT INTO pending_payments(user_id, event_id, status, selected_ts, paid_clicked_ts) VALUES(?,?,?,?,?) "
             "ON CONFLICT(user_id, event_id) DO UPDATE SET status='paid_clicked', paid_clicked_ts=excluded.paid_clicked_ts",
             (user_id, event_id, "paid_clicked", now_ts, now_ts)
         )
-        await db.commit()
 
 async def db_payment_mark_approved(user_id: int, event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_tx() as db:
         await db.execute(
             "UPDATE pending_payments SET status='approved' WHERE user_id=? AND event_id=?",
             (user_id, event_id)
         )
-        await db.commit()
 
 async def db_payment_mark_declined(user_id: int, event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_tx() as db:
         await db.execute(
             "UPDATE pending_payments SET status='declined' WHERE user_id=? AND event_id=?",
             (user_id, event_id)
         )
-        await db.commit()
 
 async def db_payment_mark_cancelled(user_id: int, event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_tx() as db:
         await db.execute(
             "UPDATE pending_payments SET status='cancelled' WHERE user_id=? AND event_id=?",
             (user_id, event_id)
         )
-        await db.commit()
 
-async def admin_send_user_log(bot: Bot, user_id: int, text: str):
-    msg = await bot.send_message(ADMIN_CHAT_ID, text)
-    await db_add_admin_map(msg.message_id, user_id)
-    return msg
+async def admin_send_request(user_id: int, event_id: int, text: str):
+    for attempt in range(1, ADMIN_REQUEST_ATTEMPTS + 1):
+        try:
+            msg = await outbound("send_message", chat_id=ADMIN_CHAT_ID, text=text, reply_markup=admin_request_kb(event_id, user_id))
+        except (TelegramNetworkError, TelegramServerError) as e:
+            if attempt == ADMIN_REQUEST_ATTEMPTS:
+                log.error("request of user %s for #%s lost after %d attempts: %s", user_id, event_id, attempt, e)
+                return
+            log.warning("request of user %s for #%s failed (attempt %d), will retry: %s", user_id, event_id, attempt, e)
+            await asyncio.sleep(ADMIN_REQUEST_RETRY_DELAY)
+        except TelegramAPIError as e:
+            log.error("request of user %s for #%s not delivered: %s", user_id, event_id, e)
+            return
+        except Exception:
+            log.exception("request of user %s for #%s failed", user_id, event_id)
+            return
+        else:
+            db_add_admin_map(msg.message_id, user_id)
+            return
+
+def admin_send_user_log(user_id: int, template: str, *args, copy_from: tuple[int, int] | None = None):
+    ADMIN_LOG_Q.put_nowait((user_id, template, args, copy_from))
+
+def admin_log_text(entries) -> str:
+    return "\n".join(
+        template.format(*args) if count == 1 else f"{template.format(*args)} (×{count})"
+        for template, args, count in entries
+    )
+
+def copy_runs(copies):
+    runs = []
+    for chat_id, message_id in copies:
+        if not runs or runs[-1][0] != chat_id or len(runs[-1][1]) >= COPY_MESSAGES_MAX:
+            runs.append((chat_id, []))
+        runs[-1][1].append(message_id)
+    return [(chat_id, sorted(ids)) for chat_id, ids in runs]
+
+async def admin_log_send(user_id: int, entries, copies):
+    try:
+        msg = await outbound("send_message", chat_id=ADMIN_CHAT_ID, text=admin_log_text(entries), disable_notification=True)
+        db_add_admin_map(msg.message_id, user_id)
+        for chat_id, message_ids in copy_runs(copies):
+            if len(message_ids) == 1:
+                copied = [await outbound("copy_message", chat_id=ADMIN_CHAT_ID, from_chat_id=chat_id, message_id=message_ids[0])]
+            else:
+                copied = await outbound("copy_messages", chat_id=ADMIN_CHAT_ID, from_chat_id=chat_id, message_ids=message_ids)
+            for c in copied:
+                db_add_admin_map(c.message_id, user_id)
+    except TelegramAPIError as e:
+        log.warning("admin log for user %s not delivered: %s", user_id, e)
+    except Exception:
+        log.exception("admin log for user %s failed", user_id)
+
+async def admin_log_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await ADMIN_LOG_Q.get()]
+        deadline = loop.time() + ADMIN_LOG_WAIT
+        while len(batch) < ADMIN_LOG_BATCH:
+            try:
+                batch.append(await asyncio.wait_for(ADMIN_LOG_Q.get(), deadline - loop.time()))
+            except asyncio.TimeoutError:
+                break
+        groups = {}
+        for user_id, template, args, copy_from in batch:
+            entries, copies = groups.setdefault(user_id, ([], []))
+            if entries and entries[-1][0] == template and entries[-1][1] == args:
+                entries[-1][2] += 1
+            else:
+                entries.append([template, args, 1])
+            if copy_from:
+                copies.append(copy_from)
+        for user_id, (entries, copies) in groups.items():
+            await admin_log_send(user_id, entries, copies)
+        for _ in batch:
+            ADMIN_LOG_Q.task_done()
 
 async def build_schedule_kb():
+    kb = events_cache_get("schedule")
+    if kb is not None:
+        return kb
+    version = EVENTS_VERSION
     events = await db_list_events_future()
-    kb = InlineKeyboardBuilder()
-    for event_id, start_ts, title, capacity, remaining, link in events:
-        text = f"{fmt_dt(start_ts)} — {title}"
-        if remaining <= 0:
-            text += " (МЕСТ НЕТ)"
-        kb.button(text=text, callback_data=f"signup:{event_id}")
-    kb.button(text="Отменить запись", callback_data="user:cancel_menu")
-    kb.button(text="Назад", callback_data="menu:back")
-    kb.adjust(1)
-    return kb.as_markup()
+    rows = [
+        [InlineKeyboardButton(
+            text=f"{fmt_dt(start_ts)} — {title} (МЕСТ НЕТ)" if remaining <= 0 else f"{fmt_dt(start_ts)} — {title}",
+            callback_data=f"signup:{event_id}"
+        )]
+        for event_id, start_ts, title, capacity, remaining, link in events
+    ]
+    rows.extend(SCHEDULE_TAIL_ROWS)
+    return events_cache_put("schedule", version, InlineKeyboardMarkup(inline_keyboard=rows))
 
 async def build_user_cancel_kb(user_id: int):
     rows = await db_user_confirmed_future_events(user_id)
-    kb = InlineKeyboardBuilder()
-    for event_id, start_ts, title, capacity, remaining, link in rows:
-        kb.button(text=f"{fmt_dt(start_ts)} — {title}", callback_data=f"user:cancel:{event_id}")
-    kb.button(text="Назад", callback_data="menu:back")
-    kb.adjust(1)
-    return kb.as_markup(), rows
-
-async def cancel_signup_flow(bot: Bot, user_id: int, event_id: int, by_admin: bool, admin_chat_id: int | None = None):
-    ev = await db_get_event(event_id)
+    kb = [
+        [InlineKeyboardButton(text=f"{fmt_dt(start_ts)} — {title}", callback_data=f"user:cancel:{event_id}")]
+        for event_id, start_ts, title, capacity, remaining, link in rows
+    ]
+    kb.append(list(BACK_ROW))
+    return InlineKeyboardMarkup(inline_keyboard=kb), rows
+
+async def cancel_signup_flow(user_id: int, event_id: int, by_admin: bool, admin_chat_id: int | None = None):
+    ev = await db_cancel_signup_atomic(user_id, event_id)
     if not ev:
-        return False, "Встреча недоступна."
-    _, start_ts, title, capacity, remaining, link = ev
-    s = await db_signup_get(user_id, event_id)
-    if not s or s[0] != "confirmed":
-        return False, "Пользователь не записан(а) на эту встречу."
-    await db_set_signup_cancelled(user_id, event_id)
-    await db_event_increment_remaining(event_id)
-    await db_payment_mark_cancelled(user_id, event_id)
-    try:
-        await bot.send_message(user_id, f"Ваша запись отменена: {fmt_dt(start_ts)} — {title}")
-    except:
-        pass
+        if not await db_get_event(event_id):
+            return False, "Встреча недоступна.", None
+        return False, "Пользователь не записан(а) на эту встречу.", None
+    start_ts, title = ev
+    sends = [outbound("send_message", chat_id=user_id, text=f"Ваша запись отменена: {fmt_dt(start_ts)} — {title}")]
     if by_admin and admin_chat_id:
-        await bot.send_message(admin_chat_id, f"Отменено: пользователь (id={user_id}) — #{event_id} {fmt_dt(start_ts)} — {title}")
-    return True, f"Запись отменена: #{event_id} {fmt_dt(start_ts)} — {title}"
+        sends.append(outbound("send_message", chat_id=admin_chat_id, text=f"Отменено: пользователь (id={user_id}) — #{event_id} {fmt_dt(start_ts)} — {title}"))
+    await gather_logged(f"cancel of #{event_id} for user {user_id}", *sends)
+    return True, f"Запись отменена: #{event_id} {fmt_dt(start_ts)} — {title}", ev
 
 @router.message(CommandStart())
-async def start(m: Message, bot: Bot):
-    if not is_admin(m.chat.id) and await db_is_blocked(m.from_user.id):
+async def start(m: Message):
+    if not is_admin(m.chat.id) and db_is_blocked(m.from_user.id):
         return
-    await db_user_upsert(m.from_user)
     uname = user_label(m.from_user)
-    await admin_send_user_log(bot, m.from_user.id, f"ℹ️ {uname} (id={m.from_user.id}) запустил(а) бота")
-    await m.answer(
-        f"Дорогая <i>{uname}</i>, нам очень приятно, что вас заинтересовал наш разговорный клуб! "
-        f"Выберите то, что вас интересует или задайте вопрос в этом чате!",
-        reply_markup=main_menu_kb(),
-        parse_mode="HTML"
+    admin_send_user_log(m.from_user.id, "ℹ️ {} (id={}) запустил(а) бота", uname, m.from_user.id)
+    await asyncio.gather(
+        db_user_upsert(m.from_user),
+        m.answer(
+            f"Дорогая <i>{uname}</i>, нам очень приятно, что вас заинтересовал наш разговорный клуб! "
+            f"Выберите то, что вас интересует или задайте вопрос в этом чате!",
+            reply_markup=MAIN_MENU_KB,
+            parse_mode="HTML"
+        )
     )
 
-@router.callback_query(F.data == "menu:back")
-async def back_main(c: CallbackQuery, bot: Bot):
-    if not is_admin(c.message.chat.id) and await db_is_blocked(c.from_user.id):
-        await c.answer()
+async def back_main(c: CallbackQuery):
+    if not is_admin(c.message.chat.id) and db_is_blocked(c.from_user.id):
         return
-    await c.message.edit_text("Выберите то, что вас интересует или задайте вопрос в этом чате!", reply_markup=main_menu_kb())
-    await c.answer()
+    await c.message.edit_text("Выберите то, что вас интересует или задайте вопрос в этом чате!", reply_markup=MAIN_MENU_KB)
 
-@router.callback_query(F.data == "menu:ask")
-async def menu_ask(c: CallbackQuery, bot: Bot):
-    if not is_admin(c.message.chat.id) and await db_is_blocked(c.from_user.id):
-        await c.answer()
+async def menu_ask(c: CallbackQuery):
+    if not is_admin(c.message.chat.id) and db_is_blocked(c.from_user.id):
         return
-    await c.message.answer("Напишите свой вопрос в чат!🫀", reply_markup=back_main_kb())
-    await c.answer()
+    await c.message.answer("Напишите свой вопрос в чат!🫀", reply_markup=BACK_MAIN_KB)
 
-@router.callback_query(F.data == "menu:schedule")
-async def schedule(c: CallbackQuery, bot: Bot):
-    if not is_admin(c.message.chat.id) and await db_is_blocked(c.from_user.id):
-        await c.answer()
+async def schedule(c: CallbackQuery):
+    if not is_admin(c.message.chat.id) and db_is_blocked(c.from_user.id):
         return
-    await db_user_upsert(c.from_user)
     uname = user_label(c.from_user)
-    await admin_send_user_log(bot, c.from_user.id, f"🗓️ {uname} (id={c.from_user.id}) открыл(а) Расписание")
+    admin_send_user_log(c.from_user.id, "🗓️ {} (id={}) открыл(а) Расписание", uname, c.from_user.id)
+    kb, _ = await asyncio.gather(build_schedule_kb(), db_user_upsert(c.from_user))
     await c.message.edit_text(
         "Выберите встречу, на которую хотите записаться 🌷\n\n"
         "Все встречи проходят по донату от 250 ₽\n"
         "Сумму вы выбираете сами.\n"
         "После выбора встречи вы сможете сразу оплатить и закрепить за собой место.",
-        reply_markup=await build_schedule_kb()
+        reply_markup=kb
     )
-    await c.answer()
 
-@router.callback_query(F.data == "user:cancel_menu")
-async def user_cancel_menu(c: CallbackQuery, bot: Bot):
-    if not is_admin(c.message.chat.id) and await db_is_blocked(c.from_user.id):
-        await c.answer()
+async def user_cancel_menu(c: CallbackQuery):
+    if not is_admin(c.message.chat.id) and db_is_blocked(c.from_user.id):
         return
     kb, rows = await build_user_cancel_kb(c.from_user.id)
     if not rows:
-        await c.message.answer("У вас нет активных записей на будущие встречи.", reply_markup=back_main_kb())
-        await c.answer()
+        await c.message.answer("У вас нет активных записей на будущие встречи.", reply_markup=BACK_MAIN_KB)
         return
     await c.message.answer("Выберите встречу, которую хотите отменить:", reply_markup=kb)
-    await c.answer()
 
-@router.callback_query(F.data.startswith("user:cancel:"))
-async def user_cancel_pick(c: CallbackQuery, bot: Bot):
-    if not is_admin(c.message.chat.id) and await db_is_blocked(c.from_user.id):
-        await c.answer()
+async def user_cancel_pick(c: CallbackQuery):
+    if not is_admin(c.message.chat.id) and db_is_blocked(c.from_user.id):
         return
-    event_id = int(c.data.split(":")[2])
-    ok, msg = await cancel_signup_flow(bot, c.from_user.id, event_id, by_admin=False)
-    await c.message.answer(msg, reply_markup=back_main_kb())
+    event_id = int(c.data.rpartition(":")[2])
+    ok, msg, ev = await cancel_signup_flow(c.from_user.id, event_id, by_admin=False)
+    await c.message.answer(msg, reply_markup=BACK_MAIN_KB)
     if ok:
-        ev = await db_get_event(event_id)
-        if ev:
-            _, start_ts, title, *_ = ev
-            uname = user_label(c.from_user)
-            await admin_send_user_log(bot, c.from_user.id, f"❗ Отмена пользователем: {uname} (id={c.from_user.id}) отменил(а) #{event_id} {fmt_dt(start_ts)} — {title}")
-    await c.answer()
+        start_ts, title = ev
+        admin_send_user_log(
+            c.from_user.id, "❗ Отмена пользователем: {} (id={}) отменил(а) #{} {} — {}",
+            user_label(c.from_user), c.from_user.id, event_id, fmt_dt(start_ts), title
+        )
 
-@router.callback_query(F.data.startswith("signup:"))
-async def signup_request(c: CallbackQuery, bot: Bot):
-    if not is_admin(c.message.chat.id) and await db_is_blocked(c.from_user.id):
-        await c.answer()
+async def signup_request(c: CallbackQuery):
+    if not is_admin(c.message.chat.id) and db_is_blocked(c.from_user.id):
         return
     await db_user_upsert(c.from_user)
-    event_id = int(c.data.split(":")[1])
+    event_id = int(c.data.rpartition(":")[2])
     ev = await db_get_event(event_id)
     if not ev:
-        await c.message.answer("Эта встреча уже недоступна.", reply_markup=back_main_kb())
-        await c.answer()
+        await c.message.answer("Эта встреча уже недоступна.", reply_markup=BACK_MAIN_KB)
         return
     _, start_ts, title, capacity, remaining, link = ev
     if remaining <= 0:
-        await c.message.answer("На эту встречу уже нет мест.", reply_markup=back_main_kb())
-        await c.answer()
+        await c.message.answer("На эту встречу уже нет мест.", reply_markup=BACK_MAIN_KB)
         return
     s = await db_signup_get(c.from_user.id, event_id)
     if s and s[0] == "confirmed":
-        await c.message.answer("Вы уже записаны на эту встречу.", reply_markup=cancel_entry_btn_kb())
-        await c.answer()
+        await c.message.answer("Вы уже записаны на эту встречу.", reply_markup=CANCEL_ENTRY_KB)
         return
 
     pay = await db_payment_get(c.from_user.id, event_id)
@@ -611,26 +1122,19 @@ async def signup_request(c: CallbackQuery, bot: Bot):
         await db_add_request_log(c.from_user.id, event_id, "selected")
         await db_add_job("pay_reminder", c.from_user.id, event_id, selected_ts + 3600)
         uname = user_label(c.from_user)
-        admin_msg = await bot.send_message(
-            ADMIN_CHAT_ID,
-            f"‼️ ЗАЯВКА: {uname} (id={c.from_user.id}) выбрал(а) встречу #{event_id} {fmt_dt(start_ts)} — {title}",
-            reply_markup=admin_request_kb(event_id, c.from_user.id)
-        )
-        await db_add_admin_map(admin_msg.message_id, c.from_user.id)
-
+        spawn(admin_send_request(
+            c.from_user.id, event_id,
+            f"‼️ ЗАЯВКА: {uname} (id={c.from_user.id}) выбрал(а) встречу #{event_id} {fmt_dt(start_ts)} — {title}"
+        ))
     await c.message.answer(payment_text_html(start_ts, title), parse_mode="HTML", reply_markup=payment_kb(event_id, include_reason=True))
-    await c.answer()
 
-@router.callback_query(F.data.startswith("paydone:"))
-async def pay_done(c: CallbackQuery, bot: Bot):
-    if not is_admin(c.message.chat.id) and await db_is_blocked(c.from_user.id):
-        await c.answer()
+async def pay_done(c: CallbackQuery):
+    if not is_admin(c.message.chat.id) and db_is_blocked(c.from_user.id):
         return
-    event_id = int(c.data.split(":")[1])
+    event_id = int(c.data.rpartition(":")[2])
     ev = await db_get_event(event_id)
     if not ev:
-        await c.message.answer("Эта встреча уже недоступна.", reply_markup=back_main_kb())
-        await c.answer()
+        await c.message.answer("Эта встреча уже недоступна.", reply_markup=BACK_MAIN_KB)
         return
     _, start_ts, title, capacity, remaining, link = ev
     pay = await db_payment_get(c.from_user.id, event_id)
@@ -639,182 +1143,167 @@ async def pay_done(c: CallbackQuery, bot: Bot):
     await db_payment_mark_paid(c.from_user.id, event_id)
     await db_add_request_log(c.from_user.id, event_id, "paid_clicked")
     uname = user_label(c.from_user)
-    admin_msg = await bot.send_message(
-        ADMIN_CHAT_ID,
-        f"💳 ОПЛАТА: {uname} (id={c.from_user.id}) нажал(а) «Я оплатила» для встречи #{event_id} {fmt_dt(start_ts)} — {title}",
-        reply_markup=admin_request_kb(event_id, c.from_user.id)
-    )
-    await db_add_admin_map(admin_msg.message_id, c.from_user.id)
-    await c.message.answer("Спасибо! Мы увидим сообщение и подтвердим вашу запись после проверки оплаты.", reply_markup=back_main_kb())
-    await c.answer()
+    spawn(admin_send_request(
+        c.from_user.id, event_id,
+        f"💳 ОПЛАТА: {uname} (id={c.from_user.id}) нажал(а) «Я оплатила» для встречи #{event_id} {fmt_dt(start_ts)} — {title}"
+    ))
+    await c.message.answer("Спасибо! Мы увидим сообщение и подтвердим вашу запись после проверки оплаты.", reply_markup=BACK_MAIN_KB)
 
-@router.callback_query(F.data.startswith("admin:approve:"))
-async def admin_approve(c: CallbackQuery, bot: Bot):
+async def admin_approve(c: CallbackQuery):
     if not is_admin(c.message.chat.id):
-        await c.answer()
         return
-    _, _, event_id_s, user_id_s = c.data.split(":")
+    _, _, event_id_s, user_id_s = c.data.split(":", 3)
     event_id = int(event_id_s)
     user_id = int(user_id_s)
 
-    ev = await db_get_event(event_id)
-    if not ev:
-        await c.message.edit_text("Эта встреча уже недоступна.")
-        await c.answer()
-        return
-
-    ok = await db_event_decrement_remaining(event_id)
-    if not ok:
-        await c.message.edit_text("Не удалось подтвердить: мест уже нет.")
-        await c.answer()
+    approved = await db_approve_atomic(user_id, event_id)
+    if not approved:
+        if await db_get_event(event_id):
+            await c.message.edit_text("Не удалось подтвердить: мест уже нет.")
+        else:
+            await c.message.edit_text("Эта встреча уже недоступна.")
         return
 
-    await db_add_request_log(user_id, event_id, "approved")
-    await db_signup_confirm(user_id, event_id)
-    await db_payment_mark_approved(user_id, event_id)
-
-    _, start_ts, title, capacity, remaining, link = ev
-    await c.message.edit_text(f"✅ Подтверждено: пользователь записан на #{event_id} {fmt_dt(start_ts)} — {title}")
+    start_ts, title = approved
 
-    try:
-        await bot.send_message(
-            user_id,
-            f"Ваша запись подтверждена 🎉\n\n"
+    await gather_logged(
+        f"approve of #{event_id} for user {user_id}",
+        c.message.edit_text(f"✅ Подтверждено: пользователь записан на #{event_id} {fmt_dt(start_ts)} — {title}"),
+        outbound(
+            "send_message",
+            chat_id=user_id,
+            text=f"Ваша запись подтверждена 🎉\n\n"
             f"Вы записаны на:\n\n"
             f"<b>{fmt_dt(start_ts)} — {title}</b>\n"
-            f"🕕 {datetime.fromtimestamp(start_ts, tz=MSK).strftime('%H:%M')}\n\n"
+            f"🕕 {fmt_dt(start_ts)[-5:]}\n\n"
             "Ссылку на встречу мы пришлём вам за час в этот чат 🫀\n"
             "Спасибо за вашу поддержку и доверие!",
             parse_mode="HTML",
-            reply_markup=cancel_entry_btn_kb()
+            reply_markup=CANCEL_ENTRY_KB
         )
-    except:
-        pass
-
-    now_ts = int(datetime.now(tz=MSK).timestamp())
-    confirm_ts = int((datetime.fromtimestamp(start_ts, tz=MSK) - timedelta(hours=24)).timestamp())
-    reminder_ts = int((datetime.fromtimestamp(start_ts, tz=MSK) - timedelta(hours=1)).timestamp())
-
-    await db_add_job("confirm", user_id, event_id, now_ts if confirm_ts <= now_ts else confirm_ts)
-    await db_add_job("reminder", user_id, event_id, now_ts if reminder_ts <= now_ts else reminder_ts)
-    await db_add_job("start_notice", user_id, event_id, start_ts if start_ts > now_ts else now_ts)
-
-    await c.answer()
+    )
 
-@router.callback_query(F.data.startswith("admin:decline:"))
-async def admin_decline(c: CallbackQuery, bot: Bot):
+async def admin_decline(c: CallbackQuery):
     if not is_admin(c.message.chat.id):
-        await c.answer()
         return
-    _, _, event_id_s, user_id_s = c.data.split(":")
+    _, _, event_id_s, user_id_s = c.data.split(":", 3)
     event_id = int(event_id_s)
     user_id = int(user_id_s)
-    ev = await db_get_event(event_id)
-    await db_add_request_log(user_id, event_id, "declined")
-    await db_payment_mark_declined(user_id, event_id)
+    ev = await db_decline_atomic(user_id, event_id)
     if ev:
-        _, start_ts, title, *_ = ev
-        await c.message.edit_text(f"❌ Отклонено: заявка на #{event_id} {fmt_dt(start_ts)} — {title}")
-        try:
-            await bot.send_message(user_id, f"К сожалению, вашу запись на {fmt_dt(start_ts)} — {title} мы не подтвердили.")
-        except:
-            pass
+        start_ts, title = ev
+        await gather_logged(
+            f"decline of #{event_id} for user {user_id}",
+            c.message.edit_text(f"❌ Отклонено: заявка на #{event_id} {fmt_dt(start_ts)} — {title}"),
+            outbound("send_message", chat_id=user_id, text=f"К сожалению, вашу запись на {fmt_dt(start_ts)} — {title} мы не подтвердили.")
+        )
     else:
         await c.message.edit_text("❌ Отклонено: встреча уже недоступна.")
-    await c.answer()
 
-@router.callback_query(F.data.startswith("confirm:"))
-async def user_confirm(c: CallbackQuery, bot: Bot):
-    if not is_admin(c.message.chat.id) and await db_is_blocked(c.from_user.id):
-        await c.answer()
+async def user_confirm(c: CallbackQuery):
+    if not is_admin(c.message.chat.id) and db_is_blocked(c.from_user.id):
         return
-    _, event_id_s, ans = c.data.split(":")
+    _, event_id_s, ans = c.data.split(":", 2)
     event_id = int(event_id_s)
-    s = await db_signup_get(c.from_user.id, event_id)
-    ev = await db_get_event(event_id)
-    if not s or s[0] != "confirmed" or not ev:
+    row = await db_signup_event(c.from_user.id, event_id)
+    if not row or row[0] != "confirmed":
         await c.message.edit_text("Эта встреча уже недоступна.")
-        await c.answer()
         return
-    _, start_ts, title, capacity, remaining, link = ev
+    _, start_ts, title = row
 
     if ans == "yes":
         await db_set_confirm_status(c.from_user.id, event_id, "yes")
         await c.message.edit_text("Спасибо, ждем вас!")
         uname = user_label(c.from_user)
-        await admin_send_user_log(bot, c.from_user.id, f"✅ Подтверждение: {uname} (id={c.from_user.id}) подтвердил(а) участие в #{event_id} {fmt_dt(start_ts)} — {title}")
+        admin_send_user_log(
+            c.from_user.id, "✅ Подтверждение: {} (id={}) подтвердил(а) участие в #{} {} — {}",
+            uname, c.from_user.id, event_id, fmt_dt(start_ts), title
+        )
     else:
-        await db_set_confirm_status(c.from_user.id, event_id, "no")
-        await db_set_signup_cancelled(c.from_user.id, event_id)
-        await db_event_increment_remaining(event_id)
-        await db_payment_mark_cancelled(c.from_user.id, event_id)
+        if not await db_cancel_signup_atomic(c.from_user.id, event_id):
+            await c.message.edit_text("Эта встреча уже недоступна.")
+            return
         await c.message.edit_text("Жаль, что вы не сможете к нам прийти.")
         uname = user_label(c.from_user)
-        await admin_send_user_log(bot, c.from_user.id, f"❗ Отмена: {uname} (id={c.from_user.id}) отказался(лась) от #{event_id} {fmt_dt(start_ts)} — {title}")
-    await c.answer()
+        admin_send_user_log(
+            c.from_user.id, "❗ Отмена: {} (id={}) отказался(лась) от #{} {} — {}",
+            uname, c.from_user.id, event_id, fmt_dt(start_ts), title
+        )
 
 @router.message(F.chat.id == ADMIN_CHAT_ID, F.reply_to_message)
-async def admin_reply(m: Message, bot: Bot):
+async def admin_reply(m: Message):
     uid = await db_get_mapped_user(m.reply_to_message.message_id)
     if uid:
-        await bot.copy_message(chat_id=uid, from_chat_id=m.chat.id, message_id=m.message_id)
+        await outbound("copy_message", chat_id=uid, from_chat_id=m.chat.id, message_id=m.message_id)
+    elif m.reply_to_message.from_user and m.reply_to_message.from_user.id == BOT.id:
+        await m.reply("Не удалось определить пользователя для этого сообщения. Ответьте через /to <user_id> <текст>.")
 
 @router.message(Command("to"))
-async def admin_to(m: Message, bot: Bot):
+async def admin_to(m: Message):
     if not is_admin(m.chat.id):
         return
-    parts = (m.text or "").split(maxsplit=2)
-    if len(parts) < 3:
-        await m.answer("Формат: /to <user_id> <текст>")
+    _, rest = next_arg(m.text or "")
+    uid_s, payload = next_arg(rest)
+    if not payload:
+        await m.answer(HELP_TO)
         return
     try:
-        uid = int(parts[1])
-    except:
-        await m.answer("Формат: /to <user_id> <текст>")
+        uid = int(uid_s)
+    except ValueError:
+        await m.answer(HELP_TO)
         return
-    await bot.send_message(uid, parts[2])
+    await outbound("send_message", chat_id=uid, text=payload)
 
 @router.message(Command("events"))
-async def admin_events(m: Message, bot: Bot):
+async def admin_events(m: Message):
     if not is_admin(m.chat.id):
         return
-    rows = await db_list_events_recent_for_admin()
-    if not rows:
+    text = events_cache_get("admin_events")
+    if text is None:
+        version = EVENTS_VERSION
+        rows = await db_list_events_recent_for_admin()
+        lines = []
+        now_ts = unix_now()
+        for event_id, start_ts, title, capacity, remaining, link in rows:
+            status = "прошла" if start_ts <= now_ts else "активна"
+            left_text = "МЕСТ НЕТ" if remaining <= 0 else f"{remaining}/{capacity}"
+            link_txt = "link✅" if (link or "").strip() else "link—"
+            lines.append(f"#{event_id} {fmt_dt(start_ts)} — {title} ({left_text}, {link_txt}, {status})")
+        text = events_cache_put("admin_events", version, "\n".join(lines))
+    if not text:
         await m.answer("Расписание пустое.")
         return
-    lines = []
-    now_ts = int(datetime.now(tz=MSK).timestamp())
-    for event_id, start_ts, title, capacity, remaining, link in rows:
-        status = "прошла" if start_ts <= now_ts else "активна"
-        left_text = "МЕСТ НЕТ" if remaining <= 0 else f"{remaining}/{capacity}"
-        link_txt = "link✅" if (link or "").strip() else "link—"
-        lines.append(f"#{event_id} {fmt_dt(start_ts)} — {title} ({left_text}, {link_txt}, {status})")
-    await m.answer("\n".join(lines))
+    await m.answer(text)
 
 @router.message(Command("add_event"))
-async def admin_add_event(m: Message, bot: Bot):
+async def admin_add_event(m: Message):
     if not is_admin(m.chat.id):
         return
-    txt = (m.text or "").strip()
-    parts = txt.split(maxsplit=4)
-    if len(parts) < 5:
-        await m.answer("Формат: /add_event YYYY-MM-DD HH:MM <места> <название>")
+    _, rest = next_arg((m.text or "").strip())
+    date_s, rest = next_arg(rest)
+    time_s, rest = next_arg(rest)
+    cap_s, title = next_arg(rest)
+    if not title:
+        await m.answer(HELP_ADD_EVENT)
         return
-    date_s, time_s, cap_s, title = parts[1], parts[2], parts[3], parts[4]
     try:
         cap = int(cap_s)
         if cap <= 0:
             raise ValueError
-    except:
-        await m.answer("Места должны быть числом > 0. Формат: /add_event YYYY-MM-DD HH:MM <места> <название>")
+    except ValueError:
+        await m.answer(f"Места должны быть числом > 0. {HELP_ADD_EVENT}")
         return
     try:
-        dt = datetime.strptime(f"{date_s} {time_s}", "%Y-%m-%d %H:%M").replace(tzinfo=MSK)
+        if len(date_s) != 10 or date_s[4] != "-" or date_s[7] != "-" or len(time_s) != 5 or time_s[2] != ":":
+            raise ValueError
+        if not (date_s[0:4] + date_s[5:7] + date_s[8:10] + time_s[0:2] + time_s[3:5]).isdigit():
+            raise ValueError
+        dt = datetime(int(date_s[0:4]), int(date_s[5:7]), int(date_s[8:10]), int(time_s[0:2]), int(time_s[3:5]), tzinfo=MSK)
         start_ts = int(dt.timestamp())
-    except:
+    except ValueError:
         await m.answer("Дата/время неверные. Формат: YYYY-MM-DD HH:MM (по МСК)")
         return
-    now_ts = int(datetime.now(tz=MSK).timestamp())
+    now_ts = unix_now()
     if start_ts <= now_ts:
         await m.answer("Нельзя добавить встречу в прошлом.")
         return
@@ -822,27 +1311,29 @@ async def admin_add_event(m: Message, bot: Bot):
     await m.answer(f"Добавлено: #{eid} {fmt_dt(start_ts)} — {title} (мест: {cap})")
 
 @router.message(Command("del_event"))
-async def admin_del_event(m: Message, bot: Bot):
+async def admin_del_event(m: Message):
     if not is_admin(m.chat.id):
         return
-    parts = (m.text or "").split(maxsplit=1)
-    if len(parts) < 2 or not parts[1].isdigit():
-        await m.answer("Формат: /del_event <event_id>")
+    _, eid_s = next_arg(m.text or "")
+    eid_s = eid_s.rstrip()
+    if not eid_s.isdigit():
+        await m.answer(HELP_DEL_EVENT)
         return
-    eid = int(parts[1])
+    eid = int(eid_s)
     await db_delete_event(eid)
     await m.answer(f"Удалено (если существовало): #{eid}")
 
 @router.message(Command("set_link"))
-async def admin_set_link(m: Message, bot: Bot):
+async def admin_set_link(m: Message):
     if not is_admin(m.chat.id):
         return
-    parts = (m.text or "").split(maxsplit=2)
-    if len(parts) < 3 or not parts[1].isdigit():
-        await m.answer("Формат: /set_link <event_id> <ссылка>")
+    _, rest = next_arg(m.text or "")
+    eid_s, link = next_arg(rest)
+    link = link.rstrip()
+    if not link or not eid_s.isdigit():
+        await m.answer(HELP_SET_LINK)
         return
-    eid = int(parts[1])
-    link = parts[2].strip()
+    eid = int(eid_s)
     ev = await db_get_event(eid)
     if not ev:
         await m.answer("Встреча не найдена.")
@@ -851,22 +1342,14 @@ async def admin_set_link(m: Message, bot: Bot):
     await db_set_link(eid, link)
     await m.answer(f"Ссылка сохранена для #{eid}")
 
-    now_ts = int(datetime.now(tz=MSK).timestamp())
+    now_ts = unix_now()
     if 0 < (start_ts - now_ts) < 3600:
         user_ids = await db_event_confirmed_user_ids(eid)
-        sent = 0
-        for uid in user_ids:
-            try:
-                if await db_is_blocked(uid):
-                    continue
-                await bot.send_message(uid, f"Ссылка на встречу {fmt_dt(start_ts)} — {title}:\n{link}")
-                sent += 1
-            except:
-                pass
-        await m.answer(f"Ссылка разослана записанным: {sent}/{len(user_ids)}")
+        sent, total = await broadcast_text(user_ids, f"Ссылка на встречу {fmt_dt(start_ts)} — {title}:\n{link}")
+        await m.answer(f"Ссылка разослана записанным: {sent}/{total}")
 
 @router.message(Command("stats"))
-async def admin_stats(m: Message, bot: Bot):
+async def admin_stats(m: Message):
     if not is_admin(m.chat.id):
         return
     rows = await db_list_events_recent_for_admin()
@@ -875,125 +1358,146 @@ async def admin_stats(m: Message, bot: Bot):
         return
     await m.answer("Выберите встречу:", reply_markup=admin_events_kb("stats", rows))
 
-@router.callback_query(F.data.startswith("stats:"))
-async def admin_stats_pick(c: CallbackQuery, bot: Bot):
+def _stats_row(uid: int, username: str, fn: str, ln: str) -> str:
+    if username:
+        return f"@{username} (id={uid})"
+    return f"{f'{fn} {ln}'.strip() or 'user'} (id={uid})"
+
+def stats_page_kb(event_id: int, page: int, pages: int):
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(text="◀", callback_data=f"stats:{event_id}:{page - 1}"))
+    if page < pages - 1:
+        row.append(InlineKeyboardButton(text="▶", callback_data=f"stats:{event_id}:{page + 1}"))
+    return InlineKeyboardMarkup(inline_keyboard=[row]) if row else None
+
+async def admin_stats_pick(c: CallbackQuery):
     if not is_admin(c.message.chat.id):
-        await c.answer()
         return
-    eid = int(c.data.split(":")[1])
+    parts = c.data.split(":", 2)
+    eid = int(parts[1])
+    page = int(parts[2]) if len(parts) > 2 else 0
     ev = await db_get_event(eid)
     if not ev:
         await c.message.edit_text("Встреча недоступна.")
-        await c.answer()
         return
     _, start_ts, title, capacity, remaining, link = ev
-    people = await db_event_stats(eid)
-    if not people:
+    total = await db_event_confirmed_count(eid)
+    if not total:
         await c.message.edit_text(f"#{eid} {fmt_dt(start_ts)} — {title}\nЗаписанных: 0")
-        await c.answer()
         return
-    lines = []
-    for uid, username, fn, ln in people:
-        if username:
-            lines.append(f"@{username} (id={uid})")
-        else:
-            name = " ".join([x for x in [fn, ln] if x]).strip()
-            lines.append(f"{name if name else 'user'} (id={uid})")
-    await c.message.edit_text(f"#{eid} {fmt_dt(start_ts)} — {title}\nЗаписанных: {len(people)}\n\n" + "\n".join(lines))
+    pages = -(-total // STATS_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    lines = [_stats_row(*row) async for row in db_event_stats(eid, page * STATS_PAGE_SIZE, STATS_PAGE_SIZE)]
+    header = f"#{eid} {fmt_dt(start_ts)} — {title}\nЗаписанных: {total}"
+    if pages > 1:
+        header += f" (стр. {page + 1}/{pages})"
+    await c.message.edit_text(header + "\n\n" + "\n".join(lines), reply_markup=stats_page_kb(eid, page, pages))
+
+CALLBACK_HANDLERS = MappingProxyType({
+    "menu:back": back_main,
+    "menu:ask": menu_ask,
+    "menu:schedule": schedule,
+    "user:cancel_menu": user_cancel_menu,
+})
+
+CALLBACK_PREFIX_HANDLERS = MappingProxyType({
+    "user:cancel": user_cancel_pick,
+    "signup": signup_request,
+    "paydone": pay_done,
+    "admin:approve": admin_approve,
+    "admin:decline": admin_decline,
+    "confirm": user_confirm,
+    "stats": admin_stats_pick,
+})
+
+def callback_handler(data: str):
+    handler = CALLBACK_HANDLERS.get(data)
+    if handler is not None:
+        return handler
+    head, sep, rest = data.partition(":")
+    if not sep:
+        return None
+    handler = CALLBACK_PREFIX_HANDLERS.get(head)
+    if handler is None:
+        sub, sep, _ = rest.partition(":")
+        if sep:
+            handler = CALLBACK_PREFIX_HANDLERS.get(f"{head}:{sub}")
+    return handler
+
+@router.callback_query()
+async def on_callback(c: CallbackQuery):
+    handler = callback_handler(c.data or "")
+    if handler is None:
+        await c.answer("Эта кнопка больше не активна.", cache_time=STALE_CALLBACK_CACHE_TIME)
+        return
     await c.answer()
+    await handler(c)
 
 @router.message(Command("broadcast_all"))
-async def admin_broadcast_all(m: Message, bot: Bot):
+async def admin_broadcast_all(m: Message):
     if not is_admin(m.chat.id):
         return
-    text = (m.text or "").split(maxsplit=1)
-    if len(text) < 2 or not text[1].strip():
-        await m.answer("Формат: /broadcast_all <текст>")
+    _, msg = next_arg(m.text or "")
+    if not msg.strip():
+        await m.answer(HELP_BROADCAST_ALL)
         return
-    msg = text[1]
-    users = await db_all_users()
-    sent = 0
-    for uid in users:
-        try:
-            if await db_is_blocked(uid):
-                continue
-            await bot.send_message(uid, msg)
-            sent += 1
-        except:
-            pass
-    await m.answer(f"Рассылка отправлена: {sent}/{len(users)}")
+    sent, total = await broadcast_text(db_all_active_users(), msg)
+    await m.answer(f"Рассылка отправлена: {sent}/{total}")
 
 @router.message(Command("broadcast"))
-async def admin_broadcast(m: Message, bot: Bot):
+async def admin_broadcast(m: Message):
     if not is_admin(m.chat.id):
         return
-    txt = (m.text or "").split(maxsplit=2)
-    if len(txt) < 3:
-        await m.answer("Формат: /broadcast <user_ids через запятую или @username> <текст>")
+    _, rest = next_arg(m.text or "")
+    who, msg = next_arg(rest)
+    if not msg:
+        await m.answer(HELP_BROADCAST)
         return
-    who = txt[1]
-    msg = txt[2]
-    targets = []
     tokens = [x.strip() for x in who.split(",") if x.strip()]
-    async with aiosqlite.connect(DB_PATH) as db:
-        for t in tokens:
-            if t.startswith("@"):
-                uname = t[1:]
-                cur = await db.execute("SELECT user_id FROM users WHERE username=?", (uname,))
-                row = await cur.fetchone()
-                if row:
-                    targets.append(int(row[0]))
-            else:
-                if t.isdigit():
-                    targets.append(int(t))
-    targets = list(dict.fromkeys(targets))
-    sent = 0
-    for uid in targets:
-        try:
-            if await db_is_blocked(uid):
-                continue
-            await bot.send_message(uid, msg)
-            sent += 1
-        except:
-            pass
-    await m.answer(f"Отправлено: {sent}/{len(targets)}")
+    by_username = await db_user_ids_by_username([t[1:] for t in tokens if t.startswith("@")])
+    seen: set[int] = set()
+    targets: list[int] = []
+    for t in tokens:
+        if t.startswith("@"):
+            uid = by_username.get(t[1:])
+        else:
+            uid = int(t) if t.isdigit() else None
+        if uid is not None and uid not in seen:
+            seen.add(uid)
+            targets.append(uid)
+    sent, total = await broadcast_text(targets, msg)
+    await m.answer(f"Отправлено: {sent}/{total}")
 
 @router.message(Command("broadcast_event"))
-async def admin_broadcast_event(m: Message, bot: Bot):
+async def admin_broadcast_event(m: Message):
     if not is_admin(m.chat.id):
         return
-    parts = (m.text or "").split(maxsplit=2)
-    if len(parts) < 3 or not parts[1].isdigit():
-        await m.answer("Формат: /broadcast_event <event_id> <текст>")
+    _, rest = next_arg(m.text or "")
+    event_id_s, msg = next_arg(rest)
+    if not msg or not event_id_s.isdigit():
+        await m.answer(HELP_BROADCAST_EVENT)
         return
-    event_id = int(parts[1])
-    msg = parts[2]
+    event_id = int(event_id_s)
     ev = await db_get_event(event_id)
     if not ev:
         await m.answer("Встреча не найдена.")
         return
     user_ids = await db_event_confirmed_user_ids(event_id)
-    sent = 0
-    for uid in user_ids:
-        try:
-            if await db_is_blocked(uid):
-                continue
-            await bot.send_message(uid, msg)
-            sent += 1
-        except:
-            pass
-    await m.answer(f"Отправлено записанным: {sent}/{len(user_ids)}")
+    sent, total = await broadcast_text(user_ids, msg)
+    await m.answer(f"Отправлено записанным: {sent}/{total}")
 
 @router.message(Command("thanks_event"))
-async def admin_thanks_event(m: Message, bot: Bot):
+async def admin_thanks_event(m: Message):
     if not is_admin(m.chat.id):
         return
-    parts = (m.text or "").split(maxsplit=2)
-    if len(parts) < 3 or not parts[1].isdigit():
-        await m.answer("Формат: /thanks_event <event_id> <ссылка_на_пост>")
+    _, rest = next_arg(m.text or "")
+    event_id_s, post_link = next_arg(rest)
+    post_link = post_link.rstrip()
+    if not post_link or not event_id_s.isdigit():
+        await m.answer(HELP_THANKS_EVENT)
         return
-    event_id = int(parts[1])
-    post_link = parts[2].strip()
+    event_id = int(event_id_s)
     ev = await db_get_event(event_id)
     if not ev:
         await m.answer("Встреча не найдена.")
@@ -1004,67 +1508,37 @@ async def admin_thanks_event(m: Message, bot: Bot):
         f"Будем очень рады, если вы оставите отзыв в новом посте:\n{post_link}"
     )
     user_ids = await db_event_confirmed_user_ids(event_id)
-    sent = 0
-    for uid in user_ids:
-        try:
-            if await db_is_blocked(uid):
-                continue
-            await bot.send_message(uid, text)
-            sent += 1
-        except:
-            pass
-    await m.answer(f"Спасибо-рассылка отправлена: {sent}/{len(user_ids)}")
+    sent, total = await broadcast_text(user_ids, text)
+    await m.answer(f"Спасибо-рассылка отправлена: {sent}/{total}")
 
 @router.message(Command("cancel_signup"))
-async def admin_cancel_signup(m: Message, bot: Bot):
+async def admin_cancel_signup(m: Message):
     if not is_admin(m.chat.id):
         return
-    parts = (m.text or "").split(maxsplit=2)
-    if len(parts) < 3:
-        await m.answer("Формат: /cancel_signup <event_id> <user_id или @username>")
-        return
-    if not parts[1].isdigit():
-        await m.answer("Формат: /cancel_signup <event_id> <user_id или @username>")
-        return
-    event_id = int(parts[1])
-    who = parts[2].strip()
-    user_id = None
-    if who.startswith("@"):
-        uname = who[1:]
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT user_id FROM users WHERE username=?", (uname,))
-            row = await cur.fetchone()
-            if row:
-                user_id = int(row[0])
-    else:
-        if who.isdigit():
-            user_id = int(who)
+    _, rest = next_arg(m.text or "")
+    event_id_s, who = next_arg(rest)
+    who = who.rstrip()
+    if not who or not event_id_s.isdigit():
+        await m.answer(HELP_CANCEL_SIGNUP)
+        return
+    event_id = int(event_id_s)
+    user_id = await resolve_user(who)
     if not user_id:
         await m.answer("Не найден пользователь. Укажите user_id или @username.")
         return
-    ok, msg = await cancel_signup_flow(bot, user_id, event_id, by_admin=True, admin_chat_id=m.chat.id)
+    ok, msg, _ = await cancel_signup_flow(user_id, event_id, by_admin=True, admin_chat_id=m.chat.id)
     await m.answer(msg)
 
 @router.message(Command("block"))
-async def admin_block(m: Message, bot: Bot):
+async def admin_block(m: Message):
     if not is_admin(m.chat.id):
         return
-    parts = (m.text or "").split(maxsplit=1)
-    if len(parts) < 2:
-        await m.answer("Формат: /block <user_id или @username>")
-        return
-    who = parts[1].strip()
-    user_id = None
-    if who.startswith("@"):
-        uname = who[1:]
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT user_id FROM users WHERE username=?", (uname,))
-            row = await cur.fetchone()
-            if row:
-                user_id = int(row[0])
-    else:
-        if who.isdigit():
-            user_id = int(who)
+    _, who = next_arg(m.text or "")
+    who = who.rstrip()
+    if not who:
+        await m.answer(HELP_BLOCK)
+        return
+    user_id = await resolve_user(who)
     if not user_id:
         await m.answer("Не найден пользователь. Укажите user_id или @username.")
         return
@@ -1072,121 +1546,200 @@ async def admin_block(m: Message, bot: Bot):
     await m.answer(f"Пользователь заблокирован: id={user_id}")
 
 @router.message(Command("unblock"))
-async def admin_unblock(m: Message, bot: Bot):
+async def admin_unblock(m: Message):
     if not is_admin(m.chat.id):
         return
-    parts = (m.text or "").split(maxsplit=1)
-    if len(parts) < 2:
-        await m.answer("Формат: /unblock <user_id или @username>")
-        return
-    who = parts[1].strip()
-    user_id = None
-    if who.startswith("@"):
-        uname = who[1:]
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT user_id FROM users WHERE username=?", (uname,))
-            row = await cur.fetchone()
-            if row:
-                user_id = int(row[0])
-    else:
-        if who.isdigit():
-            user_id = int(who)
+    _, who = next_arg(m.text or "")
+    who = who.rstrip()
+    if not who:
+        await m.answer(HELP_UNBLOCK)
+        return
+    user_id = await resolve_user(who)
     if not user_id:
         await m.answer("Не найден пользователь. Укажите user_id или @username.")
         return
     await db_unblock_user(user_id)
     await m.answer(f"Пользователь разблокирован: id={user_id}")
 
-@router.message()
-async def any_message(m: Message, bot: Bot):
-    if is_admin(m.chat.id):
-        return
-    if await db_is_blocked(m.from_user.id):
+@router.message(~F.chat.id.in_(ADMIN_IDS))
+async def any_message(m: Message):
+    if db_is_blocked(m.from_user.id):
         return
-    await db_user_upsert(m.from_user)
     uname = user_label(m.from_user)
-    await admin_send_user_log(bot, m.from_user.id, f"✉️ Сообщение от {uname} (id={m.from_user.id})")
-    copied = await bot.copy_message(chat_id=ADMIN_CHAT_ID, from_chat_id=m.chat.id, message_id=m.message_id)
-    await db_add_admin_map(copied.message_id, m.from_user.id)
+    admin_send_user_log(m.from_user.id, "✉️ Сообщение от {} (id={})", uname, m.from_user.id, copy_from=(m.chat.id, m.message_id))
+    await db_user_upsert(m.from_user)
+
+async def run_job(job, now_ts: int):
+    job_id, job_type, user_id, event_id, start_ts, title, link, signup_status, pay_status = job
+    if db_is_blocked(user_id) or start_ts is None:
+        return
+
+    if job_type == "pay_reminder":
+        if pay_status != "selected" or start_ts <= now_ts:
+            return
+        await outbound(
+            "send_message",
+            chat_id=user_id,
+            text="Видим, что вы выбрали встречу, но ещё не закрепили место 🫀\nЕсли вы всё ещё хотите прийти, вот ссылка на оплату:",
+            reply_markup=payment_kb(event_id, include_reason=False)
+        )
+        return
+
+    if signup_status != "confirmed":
+        return
 
-async def scheduler_loop(bot: Bot):
+    if job_type == "confirm":
+        if start_ts <= now_ts:
+            return
+        await outbound(
+            "send_message",
+            chat_id=user_id,
+            text=f"Подтвердите, пожалуйста, что вы придете на встречу: {fmt_dt(start_ts)} — {title}",
+            reply_markup=confirm_kb(event_id)
+        )
+    elif job_type == "reminder":
+        if start_ts <= now_ts:
+            return
+        if link.strip():
+            await outbound("send_message", chat_id=user_id, text=f"Напоминание: через час встреча {fmt_dt(start_ts)} — {title}\nМесто проведения: {link}")
+        else:
+            await outbound("send_message", chat_id=user_id, text=f"Напоминание: через час встреча {fmt_dt(start_ts)} — {title}\nМесто проведения: (ссылка пока не указана)")
+    elif job_type == "start_notice":
+        text = "Встреча началась, ждём вас!"
+        if link.strip():
+            text += f"\n{link}"
+        await outbound("send_message", chat_id=user_id, text=text)
+
+async def scheduler_loop():
+    global JOBS_NEXT_AT
     while True:
+        JOBS_WAKEUP.clear()
+        JOBS_NEXT_AT = float("inf")
+        timeout = SCHEDULER_MAX_SLEEP
         try:
-            await db_cleanup_old_events()
-            now_ts = int(datetime.now(tz=MSK).timestamp())
-            jobs = await db_next_jobs(now_ts, limit=100)
-            for job_id, job_type, user_id, event_id, run_ts in jobs:
-                if await db_is_blocked(user_id):
-                    await db_mark_job_sent(job_id)
-                    continue
-
-                ev = await db_get_event(event_id)
-
-                if job_type == "pay_reminder":
-                    if not ev:
-                        await db_mark_job_sent(job_id)
-                        continue
-                    pay = await db_payment_get(user_id, event_id)
-                    if not pay or pay[0] != "selected":
-                        await db_mark_job_sent(job_id)
-                        continue
-                    _, start_ts, title, capacity, remaining, link = ev
-                    if start_ts <= now_ts:
-                        await db_mark_job_sent(job_id)
+            now_ts = unix_now()
+            jobs = await db_next_jobs(now_ts, limit=SCHEDULER_BATCH)
+            done = []
+            retry = False
+            for job in jobs:
+                try:
+                    await run_job(job, now_ts)
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    attempts = JOB_ATTEMPTS.get(job[0], 0) + 1
+                    if attempts < SCHEDULER_MAX_ATTEMPTS:
+                        JOB_ATTEMPTS[job[0]] = attempts
+                        retry = True
+                        log.warning("job %s for user %s failed (attempt %d), will retry: %s", job[0], job[2], attempts, e)
                         continue
-                    await bot.send_message(
-                        user_id,
-                        "Видим, что вы выбрали встречу, но ещё не закрепили место 🫀\nЕсли вы всё ещё хотите прийти, вот ссылка на оплату:",
-                        reply_markup=payment_kb(event_id, include_reason=False)
-                    )
-                    await db_mark_job_sent(job_id)
-                    continue
-
-                s = await db_signup_get(user_id, event_id)
-                if not ev or not s or s[0] != "confirmed":
-                    await db_mark_job_sent(job_id)
-                    continue
-
-                _, start_ts, title, capacity, remaining, link = ev
-
-                if job_type == "confirm":
-                    if start_ts <= now_ts:
-                        await db_mark_job_sent(job_id)
-                        continue
-                    await bot.send_message(
-                        user_id,
-                        f"Подтвердите, пожалуйста, что вы придете на встречу: {fmt_dt(start_ts)} — {title}",
-                        reply_markup=confirm_kb(event_id)
-                    )
-                elif job_type == "reminder":
-                    if start_ts <= now_ts:
-                        await db_mark_job_sent(job_id)
-                        continue
-                    if link.strip():
-                        await bot.send_message(user_id, f"Напоминание: через час встреча {fmt_dt(start_ts)} — {title}\nМесто проведения: {link}")
-                    else:
-                        await bot.send_message(user_id, f"Напоминание: через час встреча {fmt_dt(start_ts)} — {title}\nМесто проведения: (ссылка пока не указана)")
-                elif job_type == "start_notice":
-                    text = "Встреча началась, ждём вас!"
-                    if link.strip():
-                        text += f"\n{link}"
-                    await bot.send_message(user_id, text)
-
-                await db_mark_job_sent(job_id)
-        except:
+                    log.warning("job %s for user %s dropped after %d attempts: %s", job[0], job[2], attempts, e)
+                except TelegramForbiddenError:
+                    pass
+                except TelegramAPIError as e:
+                    log.warning("job %s for user %s not delivered: %s", job[0], job[2], e)
+                except Exception:
+                    log.exception("job %s failed", job[0])
+                JOB_ATTEMPTS.pop(job[0], None)
+                done.append(job[0])
+            await db_mark_jobs_sent(done)
+            if retry:
+                timeout = SCHEDULER_RETRY_DELAY
+            elif len(jobs) == SCHEDULER_BATCH:
+                continue
+            else:
+                next_ts = await db_next_job_ts()
+                if next_ts is not None:
+                    timeout = min(SCHEDULER_MAX_SLEEP, max(0, next_ts - unix_now()))
+        except Exception:
+            log.exception("scheduler pass failed")
+            timeout = SCHEDULER_RETRY_DELAY
+        JOBS_NEXT_AT = unix_now() + timeout
+        try:
+            await asyncio.wait_for(JOBS_WAKEUP.wait(), timeout)
+        except asyncio.TimeoutError:
             pass
-        await asyncio.sleep(20)
+
+async def run_webhook(dp: Dispatcher, stop: asyncio.Event):
+    await BOT.set_webhook(f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=BOT, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=BOT)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+async def run_polling(dp: Dispatcher, stop: asyncio.Event):
+    await BOT.delete_webhook()
+    polling = asyncio.create_task(dp.start_polling(BOT, handle_signals=False, close_bot_session=False))
+    stopping = asyncio.create_task(stop.wait())
+    await asyncio.wait((polling, stopping), return_when=asyncio.FIRST_COMPLETED)
+    stopping.cancel()
+    if not polling.done():
+        await dp.stop_polling()
+    await polling
+
+async def drain_queues():
+    await ADMIN_LOG_Q.join()
+    await OUTBOUND_Q.join()
+
+async def shutdown():
+    try:
+        await asyncio.wait_for(drain_queues(), SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    for task in list(BACKGROUND_TASKS):
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    try:
+        await db_flush_admin_map()
+    except Exception:
+        log.exception("admin_map flush failed")
+    await db_close()
+    if BOT is not None:
+        await BOT.session.close()
 
 async def main():
     if not BOT_TOKEN or not ADMIN_CHAT_ID:
         raise RuntimeError("Set BOT_TOKEN and ADMIN_CHAT_ID")
-    await db_init()
-    session = AiohttpSession(proxy=PROXY_URL) if PROXY_URL else AiohttpSession()
-    bot = Bot(BOT_TOKEN, session=session)
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise RuntimeError("Set WEBHOOK_SECRET when WEBHOOK_URL is used")
+    global BOT
     dp = Dispatcher()
     dp.include_router(router)
-    asyncio.create_task(scheduler_loop(bot))
-    await dp.start_polling(bot)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await db_init()
+        session = PooledAiohttpSession(proxy=PROXY_URL)
+        BOT = Bot(BOT_TOKEN, session=session)
+        spawn(scheduler_loop())
+        spawn(admin_log_worker())
+        for _ in range(OUTBOUND_WORKERS):
+            spawn(outbound_worker())
+        spawn(db_maintenance_loop())
+        spawn(admin_map_flusher())
+        if WEBHOOK_URL:
+            await run_webhook(dp, stop)
+        else:
+            await run_polling(dp, stop)
+    finally:
+        await shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.run_until_complete(db_close())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()